@@ -1,8 +1,17 @@
+# eventlet must patch the standard library before anything else imports it.
+import eventlet
+eventlet.monkey_patch()
+
 import os
 import re
 import json
-import random
-import time
+import threading
+import functools
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import redis
+from eventlet import tpool
 from dotenv import load_dotenv
 from flask import Flask, render_template, request
 from flask_socketio import SocketIO, emit
@@ -17,13 +26,53 @@ from google.api_core.exceptions import GoogleAPIError, InvalidArgument, Resource
 load_dotenv()
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv("FLASK_SECRET_KEY", "a_very_secret_key")
-socketio = SocketIO(app, cors_allowed_origins="*")
+# With REDIS_URL set, session history lives in Redis and Socket.IO emits go through it, so several workers can serve clients.
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+socketio = SocketIO(app, cors_allowed_origins="*", message_queue=REDIS_URL, async_mode='eventlet')
 
 # --- LAZY INITIALIZATION SETUP ---
 speech_client = None
 tts_client = None
 gemini_model = None
 google_credentials = None
+roleplay_models = {}
+
+warmup_started = False
+
+# Keep the Speech/TTS HTTP/2 connections healthy between turns so TLS + HTTP/2 setup isn't paid per request.
+GRPC_CHANNEL_OPTIONS = [
+    ('grpc.keepalive_time_ms', 30000), ('grpc.keepalive_timeout_ms', 10000), ('grpc.http2.max_pings_without_data', 0),
+    ('grpc.max_send_message_length', -1), ('grpc.max_receive_message_length', -1),
+]
+GRPC_WARMUP_TIMEOUT = 10
+
+GEMINI_MODEL_NAME = 'models/gemini-1.5-flash'
+# Replies are spoken to a child, so keep them short: fewer output tokens means less Gemini time and less audio to synthesize.
+GEMINI_GENERATION_CONFIG = genai.GenerationConfig(max_output_tokens=80, temperature=0.7, stop_sequences=['Student:'])
+# Non-English replies carry the native-script reply plus its English copy, and Indic scripts take more tokens per word.
+GEMINI_TRANSLATED_GENERATION_CONFIG = genai.GenerationConfig(max_output_tokens=240, temperature=0.7, stop_sequences=['Student:'])
+GEMINI_SAFETY_SETTINGS = {
+    'HARM_CATEGORY_HARASSMENT': 'BLOCK_MEDIUM_AND_ABOVE', 'HARM_CATEGORY_HATE_SPEECH': 'BLOCK_MEDIUM_AND_ABOVE',
+    'HARM_CATEGORY_SEXUALLY_EXPLICIT': 'BLOCK_MEDIUM_AND_ABOVE', 'HARM_CATEGORY_DANGEROUS_CONTENT': 'BLOCK_MEDIUM_AND_ABOVE',
+}
+
+def run_blocking(fn, *args, **kwargs):
+    """Runs a blocking Google API call on eventlet's native thread pool so other clients keep being served.
+
+    gRPC does its I/O in C and can't be monkey-patched, so calling it directly would stall every green thread.
+    """
+    return tpool.execute(fn, *args, **kwargs)
+
+def iter_blocking(iterable):
+    """Iterates a blocking stream (e.g. a streamed Gemini response), fetching each item through run_blocking."""
+    iterator = run_blocking(iter, iterable)
+    exhausted = object()
+    while True:
+        item = run_blocking(next, iterator, exhausted)
+        if item is exhausted:
+            return
+        yield item
 
 def get_google_credentials():
     """Loads Google credentials from environment variables."""
@@ -47,6 +96,12 @@ def get_google_credentials():
         print(f"ERROR: Could not load Google credentials: {e}")
         return None
 
+def create_grpc_transport(client_class, creds):
+    """Builds a gRPC transport for a Google Cloud client on a persistent, keepalive-enabled channel."""
+    transport_class = client_class.get_transport_class('grpc')
+    channel = transport_class.create_channel(credentials=creds, options=GRPC_CHANNEL_OPTIONS)
+    return transport_class(channel=channel)
+
 def get_speech_client():
     """Initializes and returns the Speech-to-Text client."""
     global speech_client
@@ -56,7 +111,7 @@ def get_speech_client():
     print("Initializing Google Speech Client for the first time...")
     creds = get_google_credentials()
     if creds:
-        speech_client = speech.SpeechClient(credentials=creds)
+        speech_client = speech.SpeechClient(transport=create_grpc_transport(speech.SpeechClient, creds))
     return speech_client
 
 def get_tts_client():
@@ -68,7 +123,7 @@ def get_tts_client():
     print("Initializing Google TTS Client for the first time...")
     creds = get_google_credentials()
     if creds:
-        tts_client = tts.TextToSpeechClient(credentials=creds)
+        tts_client = tts.TextToSpeechClient(transport=create_grpc_transport(tts.TextToSpeechClient, creds))
     return tts_client
 
 def get_gemini_model():
@@ -82,20 +137,70 @@ def get_gemini_model():
     if GEMINI_API_KEY:
         try:
             genai.configure(api_key=GEMINI_API_KEY)
-            safety_settings = {
-                'HARM_CATEGORY_HARASSMENT': 'BLOCK_MEDIUM_AND_ABOVE', 'HARM_CATEGORY_HATE_SPEECH': 'BLOCK_MEDIUM_AND_ABOVE',
-                'HARM_CATEGORY_SEXUALLY_EXPLICIT': 'BLOCK_MEDIUM_AND_ABOVE', 'HARM_CATEGORY_DANGEROUS_CONTENT': 'BLOCK_MEDIUM_AND_ABOVE',
-            }
-            gemini_model = genai.GenerativeModel('models/gemini-1.5-flash', safety_settings=safety_settings)
+            gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME, safety_settings=GEMINI_SAFETY_SETTINGS)
         except Exception as e:
             print(f"ERROR: Could not initialize Gemini model: {e}")
     else:
         print("ERROR: GEMINI_API_KEY environment variable not set.")
     return gemini_model
 
+def warm_up_clients():
+    """Creates the Google clients, primes their gRPC channels with one cheap RPC each and pre-synthesizes fixed prompts."""
+    speech_client_instance = get_speech_client()
+    if speech_client_instance:
+        try:
+            # An empty clip is rejected (and not billed), but the round-trip still opens the channel.
+            run_blocking(
+                speech_client_instance.recognize, config=speech.RecognitionConfig(language_code="en-US"),
+                audio=speech.RecognitionAudio(content=b''), timeout=GRPC_WARMUP_TIMEOUT
+            )
+        except InvalidArgument:
+            pass
+        except GoogleAPIError as e:
+            print(f"WARNING: Could not warm up the Speech channel: {e}")
+    tts_client_instance = get_tts_client()
+    if tts_client_instance:
+        try:
+            run_blocking(tts_client_instance.list_voices, language_code="en-US", timeout=GRPC_WARMUP_TIMEOUT)
+        except GoogleAPIError as e:
+            print(f"WARNING: Could not warm up the TTS channel: {e}")
+    get_gemini_model()
+    if tts_client_instance:
+        precompute_fixed_prompts()
 
 # --- State Management ---
-conversation_history = {}
+conversation_history = {}  # in-process fallback when REDIS_URL is not set
+# Sids connected to this worker. A roleplay stream can outlive its client, so history is only written while the sid is here.
+connected_clients = set()
+HISTORY_TTL_SECONDS = 1800
+HISTORY_MAX_MESSAGES = 20  # last 10 user/model exchanges are sent back to Gemini
+
+def history_key(client_sid):
+    return f"conv:{client_sid}"
+
+def load_history(client_sid):
+    """Returns the stored roleplay session ({'scenario', 'history'}) for a client, or None."""
+    if not redis_client:
+        return conversation_history.get(client_sid)
+    raw = redis_client.get(history_key(client_sid))
+    return json.loads(raw) if raw else None
+
+def save_history(client_sid, session):
+    """Stores the session, unless the client disconnected meanwhile (its history was already deleted on disconnect)."""
+    if client_sid not in connected_clients:
+        return
+    session['history'] = session['history'][-HISTORY_MAX_MESSAGES:]
+    if not redis_client:
+        conversation_history[client_sid] = session
+        return
+    redis_client.set(history_key(client_sid), json.dumps(session), ex=HISTORY_TTL_SECONDS)
+
+def delete_history(client_sid):
+    if not redis_client:
+        conversation_history.pop(client_sid, None)
+        return
+    redis_client.delete(history_key(client_sid))
+
 ROLEPLAY_CONTEXTS = {
     "school": (
         "You are Genie, an AI English tutor. You're roleplaying as a new classmate with a child. "
@@ -114,87 +219,397 @@ ROLEPLAY_CONTEXTS = {
     "home": ("You are Genie, an AI English tutor, in a roleplay with a child about being at 'home'. Your goal is to be a kind and curious family member. Start by asking who they live with. Then, based on their response, ask them what their favorite thing to do at home is. Keep the conversation warm, natural, and encouraging. Ask one question at a time.")
 }
 
+# --- Free Chat Response Cache ---
+# Children repeat the same short utterances ("hello", "what's your name?") a lot. Free chat keeps no
+# history, so a finished (translated text + audio) payload can be replayed for a repeated utterance
+# without touching Gemini or TTS. Roleplay replies depend on the session history and are never cached.
+RESPONSE_CACHE_SIZE = 256
+_response_cache = OrderedDict()
+_response_cache_lock = threading.Lock()
+_UTTERANCE_NOISE_RE = re.compile(r"[^\w\s]+")
+
+def normalize_utterance(text):
+    """Folds case, punctuation and spacing so near-identical utterances share a cache key."""
+    return ' '.join(_UTTERANCE_NOISE_RE.sub(' ', text.lower()).split())
+
+def get_cached_response(key):
+    with _response_cache_lock:
+        payload = _response_cache.get(key)
+        if payload is not None:
+            _response_cache.move_to_end(key)
+        return payload
+
+def store_cached_response(key, payload):
+    with _response_cache_lock:
+        _response_cache[key] = payload
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > RESPONSE_CACHE_SIZE:
+            _response_cache.popitem(last=False)
+
+# --- Fixed Replies ---
+NO_SPEECH_RESPONSE = "I didn't hear anything. Could you speak up, please? 😊"
+MODEL_UNAVAILABLE_RESPONSE = "My AI brain isn't working right now. Please check the server logs."
+BLOCKED_TOPIC_RESPONSE = "I'm sorry, I can't talk about that topic. Let's discuss something else!"
+# Translations of the fixed replies are stored here, so translate_text needs no model call for them.
+# They are also available when Gemini itself is unavailable.
+_FIXED_TRANSLATIONS = {
+    NO_SPEECH_RESPONSE: {
+        "hi-IN": "मुझे कुछ सुनाई नहीं दिया। क्या आप कृपया थोड़ा ज़ोर से बोल सकते हैं? 😊",
+        "mr-IN": "मला काहीच ऐकू आलं नाही. कृपया थोडं मोठ्याने बोलाल का? 😊",
+        "gu-IN": "મને કંઈ સંભળાયું નહીં. કૃપા કરીને થોડું મોટેથી બોલશો? 😊",
+        "ta-IN": "எனக்கு எதுவும் கேட்கவில்லை. தயவுசெய்து கொஞ்சம் சத்தமாகப் பேசுவீர்களா? 😊",
+        "pa-IN": "ਮੈਨੂੰ ਕੁਝ ਸੁਣਾਈ ਨਹੀਂ ਦਿੱਤਾ। ਕਿਰਪਾ ਕਰਕੇ ਥੋੜ੍ਹਾ ਉੱਚੀ ਬੋਲੋਗੇ? 😊",
+    },
+    MODEL_UNAVAILABLE_RESPONSE: {
+        "hi-IN": "मेरा AI दिमाग अभी काम नहीं कर रहा है। कृपया सर्वर लॉग देखें।",
+        "mr-IN": "माझा AI मेंदू सध्या काम करत नाहीये. कृपया सर्व्हर लॉग तपासा.",
+        "gu-IN": "મારું AI મગજ અત્યારે કામ કરતું નથી. કૃપા કરીને સર્વર લૉગ તપાસો.",
+        "ta-IN": "என் AI மூளை இப்போது வேலை செய்யவில்லை. தயவுசெய்து சர்வர் பதிவுகளைப் பாருங்கள்.",
+        "pa-IN": "ਮੇਰਾ AI ਦਿਮਾਗ ਇਸ ਵੇਲੇ ਕੰਮ ਨਹੀਂ ਕਰ ਰਿਹਾ। ਕਿਰਪਾ ਕਰਕੇ ਸਰਵਰ ਲੌਗ ਦੇਖੋ।",
+    },
+    BLOCKED_TOPIC_RESPONSE: {
+        "hi-IN": "माफ़ कीजिए, मैं उस विषय पर बात नहीं कर सकता। चलो कुछ और बात करते हैं!",
+        "mr-IN": "माफ करा, मी त्या विषयावर बोलू शकत नाही. चला, दुसऱ्या कशाबद्दल तरी बोलूया!",
+        "gu-IN": "માફ કરજો, હું એ વિષય પર વાત કરી શકતો નથી. ચાલો, બીજી કોઈ વાત કરીએ!",
+        "ta-IN": "மன்னிக்கவும், அந்தத் தலைப்பைப் பற்றி என்னால் பேச முடியாது. வேறு ஏதாவது பேசலாம்!",
+        "pa-IN": "ਮਾਫ਼ ਕਰਨਾ, ਮੈਂ ਉਸ ਵਿਸ਼ੇ ਬਾਰੇ ਗੱਲ ਨਹੀਂ ਕਰ ਸਕਦਾ। ਚਲੋ ਕੁਝ ਹੋਰ ਗੱਲ ਕਰੀਏ!",
+    },
+}
+
+# --- TTS Audio Cache ---
+_VOICE_MAP = {"en-US": "en-US-Wavenet-D", "hi-IN": "hi-IN-Wavenet-A", "mr-IN": "mr-IN-Wavenet-A", "gu-IN": "gu-IN-Wavenet-A", "ta-IN": "ta-IN-Wavenet-A", "pa-IN": "pa-IN-Wavenet-A"}
+SUPPORTED_LANGUAGES = tuple(_VOICE_MAP)
+# Ogg Opus is much smaller for short clips; browsers that can't play it (Safari/iOS before 17) ask for MP3 instead.
+_AUDIO_CONFIGS = {
+    'ogg': {'audio_encoding': tts.AudioEncoding.OGG_OPUS, 'sample_rate_hertz': 24000},
+    'mp3': {'audio_encoding': tts.AudioEncoding.MP3},
+}
+DEFAULT_AUDIO_FORMAT = 'mp3'
+_LANG_MAP = {"hi-IN": "Hindi", "mr-IN": "Marathi", "gu-IN": "Gujarati", "ta-IN": "Tamil","pa-IN": "Punjabi"}
+# Non-English replies come back as "<native-script reply>\n---EN---\n<English version>" from a single Gemini call.
+TRANSLATION_MARKER = '---EN---'
+TTS_CACHE_SIZE = 512
+_tts_cache = OrderedDict()
+_tts_pinned = {}
+_tts_cache_lock = threading.Lock()
+# Bounded pool for synthesizing the sentences of one reply in parallel.
+TTS_MAX_WORKERS = 4
+_tts_executor = ThreadPoolExecutor(max_workers=TTS_MAX_WORKERS, thread_name_prefix='tts')
+
+# --- Text Cleanup Patterns (compiled once, used on every response) ---
+_QUOTE_RE = re.compile(r"'.*?'|\".*?\"")
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?।])\s+")
+_EMOJI_RE = re.compile("[" u"\U0001F600-\U0001F64F" u"\U0001F300-\U0001F5FF" u"\U0001F680-\U0001F6FF" u"\U0001F700-\U0001F77F" u"\U0001F780-\U0001F7FF" u"\U0001F800-\U0001F8FF" u"\U0001F900-\U0001F9FF" u"\U0001FA00-\U0001FA6F" u"\U0001FA70-\U0001FAFF" u"\U00002702-\U000027B0" u"\U000024C2-\U0001F251" "]+")
+
 # --- Helper Functions ---
-def get_gemini_free_chat_response(user_transcript):
+def reply_language_instruction(language):
+    """Prompt suffix asking Gemini to answer in the session language and append the English version after TRANSLATION_MARKER."""
+    if language.startswith('en'):
+        return ""
+    target_language_name = _LANG_MAP.get(language, "the requested language")
+    return (
+        f"\n\nReply in {target_language_name} only, written in its native script. DO NOT include transliteration. "
+        f"Then, on a new line containing only '{TRANSLATION_MARKER}', write the same reply in English."
+    )
+
+def generation_config_for(language):
+    return GEMINI_GENERATION_CONFIG if language.startswith('en') else GEMINI_TRANSLATED_GENERATION_CONFIG
+
+def canned_reply(english_text, language):
+    """Formats a fixed English reply the way Gemini formats replies for the session language."""
+    if language.startswith('en'):
+        return english_text
+    return f"{translate_text(english_text, language)}\n{TRANSLATION_MARKER}\n{english_text}"
+
+def get_roleplay_model(scenario, language):
+    """Returns a Gemini model with the scenario's context (and reply language) pinned as its system instruction."""
+    key = (scenario, language)
+    if key in roleplay_models:
+        return roleplay_models[key]
+    if not get_gemini_model():
+        return None
+
+    print(f"Initializing Gemini roleplay model for '{scenario}' in {language}...")
+    try:
+        roleplay_models[key] = genai.GenerativeModel(
+            GEMINI_MODEL_NAME, safety_settings=GEMINI_SAFETY_SETTINGS,
+            system_instruction=ROLEPLAY_CONTEXTS[scenario] + reply_language_instruction(language)
+        )
+    except Exception as e:
+        print(f"ERROR: Could not initialize roleplay model for '{scenario}' in {language}: {e}")
+        return None
+    return roleplay_models[key]
+
+def log_token_usage(label, response):
+    usage = getattr(response, 'usage_metadata', None)
+    if usage:
+        print(f"Gemini {label} reply: {usage.candidates_token_count} output tokens")
+
+def get_gemini_free_chat_response(user_transcript, language):
+    """Yields (text_piece, is_model_reply) as Gemini streams the reply; canned error replies come back with is_model_reply=False."""
     model = get_gemini_model()
-    if not model: return "My AI brain isn't working right now. Please check the server logs."
+    if not model:
+        yield canned_reply(MODEL_UNAVAILABLE_RESPONSE, language), False
+        return
     prompt = (
         "You are Genie, a friendly, patient, and encouraging AI English tutor for children. "
         "Keep your answers short, simple, and cheerful. Ask a follow-up question to keep the conversation going. "
-        "End your response with a single, suitable emoji.\n\n"
+        "End your response with a single, suitable emoji."
+        f"{reply_language_instruction(language)}\n\n"
         f"Student: {user_transcript}\nGenie:"
     )
     try:
-        response = model.generate_content(prompt)
-        return response.text
+        response = run_blocking(model.generate_content, prompt, stream=True, generation_config=generation_config_for(language))
+        for chunk in iter_blocking(response):
+            yield chunk.text, True
+        log_token_usage('free chat', response)
     except ValueError:
-        return "I'm sorry, I can't talk about that topic. Let's discuss something else!"
+        yield canned_reply(BLOCKED_TOPIC_RESPONSE, language), False
     except Exception as e:
-        return f"An error occurred: {e}"
+        yield canned_reply(f"An error occurred: {e}", language), False
 
-def translate_text(text, target_language_code):
-    model = get_gemini_model()
-    if target_language_code.startswith('en') or not model:
-        return text
-    lang_map = {"hi-IN": "Hindi", "mr-IN": "Marathi", "gu-IN": "Gujarati", "ta-IN": "Tamil","pa-IN": "Punjabi"}
-    target_language_name = lang_map.get(target_language_code, "the requested language")
+def get_gemini_roleplay_response(client_sid, user_text, scenario, language):
+    """Yields (text_piece, is_model_reply) as Gemini streams the roleplay reply, then records the turn in the session history."""
+    roleplay_model = get_roleplay_model(scenario, language)
+    if not roleplay_model:
+        yield canned_reply(MODEL_UNAVAILABLE_RESPONSE, language), False
+        return
+    session = load_history(client_sid)
+    if not session or session.get('scenario') != scenario or session.get('language') != language:
+        session = {'scenario': scenario, 'language': language, 'history': []}
+    # The scenario context lives in the model's system instruction, so history only holds the actual turns.
+    # Passing them straight to generate_content skips building and validating a ChatSession on every turn.
+    user_turn = {'role': 'user', 'parts': [user_text]}
+    reply_parts = []
+    response = run_blocking(roleplay_model.generate_content, session['history'] + [user_turn], stream=True, generation_config=generation_config_for(language))
+    for chunk in iter_blocking(response):
+        reply_parts.append(chunk.text)
+        yield chunk.text, True
+    log_token_usage(f"roleplay '{scenario}'", response)
+    session['history'].append(user_turn)
+    session['history'].append({'role': 'model', 'parts': [''.join(reply_parts)]})
+    save_history(client_sid, session)
+
+@functools.lru_cache(maxsize=512)
+def _translate_cached(text, target_language_code):
+    """Gemini translation, memoized per (text, language). Errors propagate so failures are not cached."""
+    target_language_name = _LANG_MAP.get(target_language_code, "the requested language")
     prompt = (
         f"Translate the following English text for a child into {target_language_name}. "
         f"Provide ONLY the translation in the native script. DO NOT include transliteration.\n\n"
         f"English Text: '{text}'"
     )
+    response = run_blocking(get_gemini_model().generate_content, prompt)
+    return response.text
+
+def translate_text(text, target_language_code):
+    if target_language_code.startswith('en'):
+        return text
+    fixed_translation = _FIXED_TRANSLATIONS.get(text, {}).get(target_language_code)
+    if fixed_translation:
+        return fixed_translation
+    model = get_gemini_model()
+    if not model:
+        return text
     try:
-        response = model.generate_content(prompt)
-        return response.text
+        return _translate_cached(text, target_language_code)
     except Exception as e:
         return text
 
+def synthesize_speech(text_for_speech, language, audio_format, pin=False):
+    """Returns TTS audio bytes in audio_format, served from the audio caches when the same (text, language, format) was spoken before.
+
+    Pinned entries (fixed prompts such as NO_SPEECH_RESPONSE) are kept for the life of the process;
+    everything else goes through a bounded LRU.
+    """
+    key = (text_for_speech, language, audio_format)
+    with _tts_cache_lock:
+        if key in _tts_pinned:
+            return _tts_pinned[key]
+        if key in _tts_cache:
+            _tts_cache.move_to_end(key)
+            return _tts_cache[key]
+
+    # --- FIX: Use a different variable name to avoid shadowing the library import ---
+    tts_client_instance = get_tts_client()
+    if not tts_client_instance: raise ConnectionError("TTS client is not initialized.")
+
+    # --- FIX: Use the 'tts' library alias for these configuration objects ---
+    synthesis_input = tts.SynthesisInput(text=text_for_speech)
+    voice = tts.VoiceSelectionParams(language_code=language, name=_VOICE_MAP.get(language, "en-US-Wavenet-D"))
+    audio_config = tts.AudioConfig(**_AUDIO_CONFIGS[audio_format], effects_profile_id=['small-bluetooth-speaker-class-device'])
+
+    # --- FIX: Use the client instance to make the API call ---
+    tts_response = run_blocking(tts_client_instance.synthesize_speech, input=synthesis_input, voice=voice, audio_config=audio_config)
+    audio_content = tts_response.audio_content
+
+    with _tts_cache_lock:
+        if pin:
+            _tts_pinned[key] = audio_content
+        else:
+            _tts_cache[key] = audio_content
+            while len(_tts_cache) > TTS_CACHE_SIZE:
+                _tts_cache.popitem(last=False)
+    return audio_content
+
+def clean_text_for_speech(text):
+    """Drops the parts of a reply that shouldn't be read aloud: parentheticals, quoted text and emoji."""
+    if '(' in text: text = text.split('(', 1)[0].strip()
+    text = _QUOTE_RE.sub('', text)
+    return _EMOJI_RE.sub('', text)
+
+def split_sentences(text):
+    return [sentence for sentence in (part.strip() for part in _SENTENCE_END_RE.split(text)) if sentence]
+
+def iter_sentences(text_pieces):
+    """Regroups streamed text pieces into sentences, yielding each one as soon as it is complete."""
+    buffer = ''
+    for piece in text_pieces:
+        buffer += piece
+        *complete, buffer = _SENTENCE_END_RE.split(buffer)
+        for sentence in complete:
+            if sentence.strip(): yield sentence.strip()
+    if buffer.strip():
+        yield buffer.strip()
+
+def iter_until_marker(text_pieces, marker):
+    """Yields streamed text up to marker, holding back any tail that could be the start of it.
+
+    Stops as soon as the marker is seen, so the caller can finish with the text before it right away;
+    the caller is responsible for draining the rest of the stream.
+    """
+    buffer = ''
+    for piece in text_pieces:
+        buffer += piece
+        if marker in buffer:
+            yield buffer.split(marker, 1)[0]
+            return
+        safe_length = len(buffer) - len(marker) + 1
+        if safe_length > 0:
+            yield buffer[:safe_length]
+            buffer = buffer[safe_length:]
+    yield buffer
+
+def precompute_fixed_prompts():
+    """Translates and synthesizes NO_SPEECH_RESPONSE for every language and audio format into the pinned TTS cache in one batch."""
+    futures = []
+    for language in SUPPORTED_LANGUAGES:
+        for sentence in split_sentences(translate_text(NO_SPEECH_RESPONSE, language)):
+            text_for_speech = clean_text_for_speech(sentence).strip()
+            if not text_for_speech: continue
+            for audio_format in _AUDIO_CONFIGS:
+                futures.append(_tts_executor.submit(synthesize_speech, text_for_speech, language, audio_format, True))
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            print(f"WARNING: Could not precompute fixed prompt audio: {e}")
+
 # --- Core Logic Function (CORRECTED) ---
-def process_and_respond(client_sid, user_text, mode, scenario, language):
+def process_and_respond(client_sid, user_text, mode, scenario, language, audio_format=DEFAULT_AUDIO_FORMAT):
+    """Streams the reply to the client sentence by sentence, then sends 'audio_response_end' with the full text.
+
+    Works without Gemini: the no-speech prompt needs no model, and chat turns answer with MODEL_UNAVAILABLE_RESPONSE.
+
+    Each spoken sentence is an 'audio_response_meta' event (its text) immediately followed by an
+    'audio_response_bin' event whose only argument is the raw audio bytes.
+    """
     try:
-        model = get_gemini_model()
-        if not model: raise ConnectionError("Gemini model is not initialized.")
+        # The language comes straight from the client and keys the roleplay model cache, the prompt and the TTS voice.
+        if language not in SUPPORTED_LANGUAGES:
+            print(f"Unsupported language '{language}' from {client_sid}; falling back to en-US")
+            language = "en-US"
+        if audio_format not in _AUDIO_CONFIGS: audio_format = DEFAULT_AUDIO_FORMAT
+
+        is_roleplay = mode == 'roleplay' and scenario in ROLEPLAY_CONTEXTS
+        cache_key = None
+        if not is_roleplay and user_text.strip():
+            cache_key = (normalize_utterance(user_text), language, audio_format)
+            cached_events = get_cached_response(cache_key)
+            if cached_events:
+                delete_history(client_sid)
+                for event, data in cached_events: emit(event, data)
+                print(f"Sent cached response for {client_sid} in {language}")
+                return
 
         if not user_text.strip():
-            english_response_text = "I didn't hear anything. Could you speak up, please? 😊"
+            reply_pieces = [(canned_reply(NO_SPEECH_RESPONSE, language), False)]
+        elif is_roleplay:
+            reply_pieces = get_gemini_roleplay_response(client_sid, user_text, scenario, language)
         else:
-            if mode == 'roleplay' and scenario in ROLEPLAY_CONTEXTS:
-                if client_sid not in conversation_history or conversation_history[client_sid].get('scenario') != scenario:
-                    context = ROLEPLAY_CONTEXTS[scenario]
-                    conversation_history[client_sid] = {
-                        'scenario': scenario,
-                        'history': [{'role': 'user', 'parts': [context]}, {'role': 'model', 'parts': ["Okay, I'm ready to start the roleplay!"]}]
-                    }
-                conversation_history[client_sid]['history'].append({'role': 'user', 'parts': [user_text]})
-                chat_session = model.start_chat(history=conversation_history[client_sid]['history'])
-                response = chat_session.send_message(user_text)
-                english_response_text = response.text
-                conversation_history[client_sid]['history'].append({'role': 'model', 'parts': [english_response_text]})
-            else:
-                if client_sid in conversation_history: del conversation_history[client_sid]
-                english_response_text = get_gemini_free_chat_response(user_text)
-        
-        translated_text = translate_text(english_response_text, language)
-        text_for_speech = translated_text
-        if '(' in text_for_speech: text_for_speech = text_for_speech.split('(', 1)[0].strip()
-        text_for_speech = re.sub(r"'.*?'|\".*?\"", '', text_for_speech)
-        emoji_pattern = re.compile("[" u"\U0001F600-\U0001F64F" u"\U0001F300-\U0001F5FF" u"\U0001F680-\U0001F6FF" u"\U0001F700-\U0001F77F" u"\U0001F780-\U0001F7FF" u"\U0001F800-\U0001F8FF" u"\U0001F900-\U0001F9FF" u"\U0001FA00-\U0001FA6F" u"\U0001FA70-\U0001FAFF" u"\U00002702-\U000027B0" u"\U000024C2-\U0001F251" "]+", flags=re.UNICODE)
-        text_for_speech = emoji_pattern.sub(r'', text_for_speech)
-        
-        # --- FIX: Use a different variable name to avoid shadowing the library import ---
-        tts_client_instance = get_tts_client()
-        if not tts_client_instance: raise ConnectionError("TTS client is not initialized.")
-        
-        # --- FIX: Use the 'tts' library alias for these configuration objects ---
-        synthesis_input = tts.SynthesisInput(text=text_for_speech)
-        voice_map = {"en-US": "en-US-Wavenet-D", "hi-IN": "hi-IN-Wavenet-A", "mr-IN": "mr-IN-Wavenet-A", "gu-IN": "gu-IN-Wavenet-A", "ta-IN": "ta-IN-Wavenet-A", "pa-IN": "pa-IN-Wavenet-A"}
-        voice = tts.VoiceSelectionParams(language_code=language, name=voice_map.get(language, "en-US-Wavenet-D"))
-        audio_config = tts.AudioConfig(audio_encoding=tts.AudioEncoding.MP3)
-        
-        # --- FIX: Use the client instance to make the API call ---
-        tts_response = tts_client_instance.synthesize_speech(input=synthesis_input, voice=voice, audio_config=audio_config)
-        
-        emit('audio_response', {'audio_data': tts_response.audio_content, 'translated_text': translated_text, 'original_english': english_response_text})
+            delete_history(client_sid)
+            reply_pieces = get_gemini_free_chat_response(user_text, language)
+
+        reply_parts = []
+        reply_status = {'is_model_reply': True}
+        def reply_text_pieces():
+            for piece, is_model_reply in reply_pieces:
+                reply_parts.append(piece)
+                reply_status['is_model_reply'] = reply_status['is_model_reply'] and is_model_reply
+                yield piece
+
+        reply_stream = reply_text_pieces()
+        if language.startswith('en'):
+            spoken_sentences = iter_sentences(reply_stream)
+        else:
+            # The native-script reply streams first, so it is spoken before its English copy has even arrived.
+            spoken_sentences = iter_sentences(iter_until_marker(reply_stream, TRANSLATION_MARKER))
+
+        sent_events = []
+        def send(event, data):
+            sent_events.append((event, data))
+            # Addressed by sid because the chunk sender runs outside this handler's request context.
+            socketio.emit(event, data, to=client_sid)
+
+        # Each sentence goes to TTS as soon as it's available. A separate sender task waits on the head of the
+        # queue and emits its audio the moment TTS finishes, in order, without waiting for Gemini's next sentence.
+        is_fixed_prompt = not user_text.strip()
+        pending = queue.Queue()
+        sender_errors = []
+        sender_done = threading.Event()
+        def send_chunks_in_order():
+            try:
+                while True:
+                    item = pending.get()
+                    if item is None:
+                        return
+                    sentence, future = item
+                    try:
+                        audio_content = future.result()
+                    except Exception as e:
+                        sender_errors.append(e)
+                        continue
+                    send('audio_response_meta', {'text': sentence})
+                    send('audio_response_bin', audio_content)
+            finally:
+                sender_done.set()
+
+        # Wait on sender_done rather than the task's join(): join() can return before a task that hasn't been
+        # scheduled yet has run at all, which happens when this handler never yielded (e.g. the no-speech prompt).
+        socketio.start_background_task(send_chunks_in_order)
+        try:
+            for sentence in spoken_sentences:
+                text_for_speech = clean_text_for_speech(sentence).strip()
+                if text_for_speech:
+                    pending.put((sentence, _tts_executor.submit(synthesize_speech, text_for_speech, language, audio_format, is_fixed_prompt)))
+            # Read the rest of the reply (the English copy) so the stream completes and roleplay history is saved.
+            for _ in reply_stream: pass
+        finally:
+            pending.put(None)
+            while not sender_done.is_set():
+                sender_done.wait()
+        if sender_errors: raise sender_errors[0]
+
+        reply_text = ''.join(reply_parts)
+        if language.startswith('en'):
+            translated_text = english_response_text = reply_text
+        else:
+            translated_text, _, english_response_text = (part.strip() for part in reply_text.partition(TRANSLATION_MARKER))
+            if not english_response_text: english_response_text = translated_text
+        send('audio_response_end', {'translated_text': translated_text, 'original_english': english_response_text})
+        # A reply without its English copy (or a failed translate_text) isn't a proper pair; don't pin it for a non-English session.
+        if cache_key and reply_status['is_model_reply'] and (language.startswith('en') or translated_text != english_response_text):
+            store_cached_response(cache_key, sent_events)
         print(f"Sent response for {client_sid} in {language}")
 
     except Exception as e:
@@ -208,13 +623,19 @@ def index():
 
 @socketio.on('connect')
 def handle_connect():
+    global warmup_started
     print(f'Client connected: {request.sid}')
+    connected_clients.add(request.sid)
+    if not warmup_started:
+        warmup_started = True
+        socketio.start_background_task(warm_up_clients)
 
 @socketio.on('disconnect')
 def handle_disconnect():
     client_sid = request.sid
     print(f'Client disconnected: {client_sid}')
-    if client_sid in conversation_history: del conversation_history[client_sid]
+    connected_clients.discard(client_sid)
+    delete_history(client_sid)
 
 @socketio.on('final_audio_blob')
 def handle_final_audio_blob(data):
@@ -230,12 +651,12 @@ def handle_final_audio_blob(data):
         config = speech.RecognitionConfig(encoding=speech.RecognitionConfig.AudioEncoding.WEBM_OPUS, sample_rate_hertz=48000, language_code="en-US")
         
         # --- FIX: Use the client instance to make the API call ---
-        response = speech_client_instance.recognize(config=config, audio=audio)
+        response = run_blocking(speech_client_instance.recognize, config=config, audio=audio)
         
         user_transcript = response.results[0].alternatives[0].transcript if response.results else ""
         emit('transcription', {'text': user_transcript})
         print(f"Transcript for {client_sid}: '{user_transcript}'")
-        process_and_respond(client_sid, user_transcript, data['mode'], data['scenario'], data['language'])
+        process_and_respond(client_sid, user_transcript, data['mode'], data['scenario'], data['language'], data.get('audio_format', DEFAULT_AUDIO_FORMAT))
     except Exception as e:
         print(f"ERROR in handle_final_audio_blob: {e}")
         emit('backend_message', {'message': 'Error processing audio.', 'error': str(e)})
@@ -245,9 +666,9 @@ def handle_text_message(data):
     client_sid = request.sid
     user_text = data['text']
     print(f"Text message for {client_sid}: '{user_text}'")
-    process_and_respond(client_sid, user_text, data['mode'], data['scenario'], data['language'])
+    process_and_respond(client_sid, user_text, data['mode'], data['scenario'], data['language'], data.get('audio_format', DEFAULT_AUDIO_FORMAT))
 
 if __name__ == '__main__':
     print("Starting Flask Socket.IO server...")
-    socketio.run(app, debug=True, allow_unsafe_werkzeug=True)
+    socketio.run(app, debug=True)
 
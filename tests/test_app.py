@@ -0,0 +1,28 @@
+import eventlet
+
+import app as voice_tutor
+
+
+def collect_events(client, timeout=5):
+    """Gathers received events until 'audio_response_end' arrives, then waits briefly for any stragglers."""
+    received = []
+    for _ in range(int(timeout / 0.1)):
+        received += client.get_received()
+        if any(event['name'] == 'audio_response_end' for event in received):
+            break
+        eventlet.sleep(0.1)
+    eventlet.sleep(0.5)
+    received += client.get_received()
+    return [event['name'] for event in received]
+
+
+def test_no_speech_reply_ends_with_audio_response_end(monkeypatch):
+    monkeypatch.setattr(voice_tutor, 'warmup_started', True)
+    monkeypatch.setattr(voice_tutor, 'synthesize_speech', lambda *args, **kwargs: b'audio')
+    client = voice_tutor.socketio.test_client(voice_tutor.app)
+
+    client.emit('text_message', {'text': '', 'mode': 'chat', 'scenario': '', 'language': 'hi-IN'})
+    names = collect_events(client)
+
+    assert 'audio_response_bin' in names
+    assert names[-1] == 'audio_response_end'